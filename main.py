@@ -1,8 +1,14 @@
+import argparse
 import ast
 import builtins
 import collections
+import concurrent.futures
+import functools
+import hashlib
+import itertools
 import json
 import os
+import pickle
 import sys
 
 if sys.version_info < (3, 11):
@@ -10,114 +16,360 @@ if sys.version_info < (3, 11):
 else:
     import tomllib as toml
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__version__ = "0.1.1"
+
+# 파싱된 AST를 저장하는 디렉터리
+CACHE_DIR = ".py-flow-trace-cache"
+# 파일별 해시와 분석 결과를 저장하여 다음 실행에서 바뀌지 않은 파일의 분석을 건너뜀
+INDEX_PATH = os.path.join(CACHE_DIR, "index.json")
+# 마지막으로 쓴 template.html의 해시, 크기, 수정 시각
+TEMPLATE_HASH_PATH = os.path.join(CACHE_DIR, "template.html.hash")
+# 워커 프로세스 한 번 호출에 묶어 보낼 파일 수
+CHUNK_SIZE = 16
+
+# 호출 노드마다 isinstance로 MRO를 훑지 않고 type(...) is 로 비교하기 위한 노드 타입
+_ATTR = ast.Attribute
+_NAME = ast.Name
+
 
 class CallInfo:
     def __init__(self):
-        # caller -> [(callee, count)]
-        self.call_relations = collections.defaultdict(lambda: collections.defaultdict(int))
+        # (caller, callee) -> count
+        # 중첩 defaultdict 대신 튜플 키 하나로 저장하여 호출마다 한 번의 조회로 카운트
+        self.call_relations = collections.Counter()
 
-    def add_call(self, caller, callee):
-        self.call_relations[caller][callee] += 1
+    def add_call(self, caller, callee, count=1):
+        self.call_relations[(caller, callee)] += count
+
+    def to_dict(self):
+        # caller -> {callee: count} 형태로 다시 묶음
+        result = collections.defaultdict(dict)
+        for (caller, callee), count in self.call_relations.items():
+            result[caller][callee] = count
+        return result
 
     def display(self):
-        for caller, callees in self.call_relations.items():
+        for caller, callees in self.to_dict().items():
             print(f"{caller}:")
             for callee, count in callees.items():
                 print(f"  -> {callee} (called {count} times)")
 
 
-def get_module_path(file_path):
+@functools.lru_cache(maxsize=None)
+def get_module_path(file_path, base_path):
     # 파일 경로를 Python 모듈 경로로 변환
     module_path, _ = os.path.splitext(file_path)  # 확장자 제거
     # 설정의 path 기준으로 상대 경로로 변환
-    module_path = os.path.relpath(module_path, settings["path"])
-    return module_path.replace(os.path.sep, ".")  # 경로 구분자를 '.'으로 변경
+    module_path = os.path.relpath(module_path, base_path)
+    return sys.intern(module_path.replace(os.path.sep, "."))  # 경로 구분자를 '.'으로 변경
 
 
-class EventAnalysisVisitor(ast.NodeVisitor):
-    def __init__(self, call_info, current_file):
+class EventAnalysisVisitor:
+    def __init__(self, call_info, current_file, base_path):
         self.call_info = call_info
         self.current_class = None
         self.current_file = current_file
+        self.base_path = base_path
+        self.module_path = get_module_path(current_file, base_path)  # 호출마다 다시 계산하지 않도록 파일당 한 번만 계산
         self.current_method = None  # 현재 방문 중인 메서드를 추적하기 위한 변수 추가
+        self.current_caller = self.module_path  # 현재 스코프의 호출자(caller) 이름, 스코프에 진입할 때만 갱신
         self.imports = {}  # import 이름과 실제 모듈/클래스의 매핑을 저장
-        self.builtin_modules = dir(builtins)
-        self.third_party_modules = set()
-
-    def visit_Import(self, node):
+        self.builtin_modules = frozenset(dir(builtins))
+
+    def visit(self, tree):
+        # ast.NodeVisitor의 메서드 이름 기반 디스패치 대신 명시적 스택과 타입별 핸들러 테이블로 순회
+        # 스택 항목마다 (클래스, 메서드, 호출자) 스코프를 함께 저장하므로 스코프를 벗어나면 자동으로 복원됨
+        handlers = self.handlers
+        stack = [(tree, (None, None, self.module_path))]
+        while stack:
+            node, scope = stack.pop()
+            self.current_class, self.current_method, self.current_caller = scope
+            handler = handlers.get(type(node))
+            if handler is not None:
+                handler(self, node)
+                scope = (self.current_class, self.current_method, self.current_caller)
+            # 소스 순서대로 방문하도록 자식 노드를 역순으로 추가
+            if type(node) is ast.Call:
+                children = self.call_children(node)
+            else:
+                children = list(ast.iter_child_nodes(node))
+            children.reverse()
+            stack.extend((child, scope) for child in children)
+
+    # import 시점에 호출에서 보게 될 이름 -> 최종 모듈 경로를 미리 계산해 두어
+    # handle_Call에서는 dict 조회 한 번으로 변환이 끝나게 함
+    def handle_Import(self, node):
         for alias in node.names:
-            self.imports[alias.name] = alias.name
-        self.generic_visit(node)
-
-    def visit_ImportFrom(self, node):
-        module = node.module
+            if alias.asname:
+                # import a.b as c -> c는 a.b
+                self.imports[alias.asname] = alias.name
+            else:
+                # import a.b -> 바인딩되는 이름은 a
+                top_level = alias.name.partition(".")[0]
+                self.imports[top_level] = top_level
+
+    def handle_ImportFrom(self, node):
+        module = self.resolve_module(node)
         for alias in node.names:
-            full_name = f"{module}.{alias.name}"
-            self.imports[alias.name] = full_name
-        self.generic_visit(node)
-
-    def visit_ClassDef(self, node):
+            if alias.name == "*":
+                continue
+            full_name = f"{module}.{alias.name}" if module else alias.name
+            self.imports[alias.asname or alias.name] = full_name
+
+    def resolve_module(self, node):
+        if not node.level:
+            return node.module
+        # 상대 import는 현재 모듈 경로를 기준으로 절대 경로로 변환
+        # (app/services/users.py, app/services/__init__.py 모두 패키지는 app.services)
+        parts = self.module_path.split(".")[: -node.level]
+        if node.module:
+            parts.append(node.module)
+        return ".".join(parts)
+
+    def handle_ClassDef(self, node):
         self.current_class = node.name
-        self.generic_visit(node)
-        self.current_class = None
-        self.current_method = None  # 클래스를 벗어날 때 컨텍스트 리셋
+        self.current_method = None
+        self.current_caller = sys.intern(f"{self.module_path}.{node.name}")
 
-    def visit_FunctionDef(self, node):
+    def handle_FunctionDef(self, node):
         if self.current_class:  # 클래스 내부의 메서드인 경우
             self.current_method = node.name
-        self.generic_visit(node)
-        self.current_method = None  # 메서드 방문이 끝날 때 컨텍스트 리셋
-
-    def visit_Call(self, node):
-        callee = self.get_callee(node)
-        if callee:
-            if callee not in self.builtin_modules:
-                # 현재 클래스와 메서드 정보를 기반으로 호출자(caller) 식별
-                if self.current_class and self.current_method:
-                    if self.current_method == "__init__":
-                        # 생성자 호출은 클래스 이름으로 기록
-                        caller = f"{get_module_path(self.current_file)}.{self.current_class}"
-                    else:
-                        caller = f"{get_module_path(self.current_file)}.{self.current_class}.{self.current_method}"
-                elif self.current_class:
-                    caller = f"{get_module_path(self.current_file)}.{self.current_class}"
-                else:
-                    # 파일의 전역 스코프에서의 호출은 GlobalScope 표기 대신 파일 경로 기반으로 기록
-                    caller = f"{get_module_path(self.current_file)}"
-
-                # imports 매핑을 사용하여 callee의 모듈 경로 변환
-                parts = callee.split(".")
-                if parts[0] in self.imports:
-                    parts[0] = self.imports[parts[0]]
-                    callee = ".".join(parts)
-
-                    self.call_info.add_call(caller, callee)
-        self.generic_visit(node)
+            if node.name == "__init__":
+                # 생성자 호출은 클래스 이름으로 기록
+                self.current_caller = sys.intern(f"{self.module_path}.{self.current_class}")
+            else:
+                self.current_caller = sys.intern(f"{self.module_path}.{self.current_class}.{node.name}")
+
+    def handle_Call(self, node):
+        # callee를 "head.attr" 문자열로 만든 뒤 split/join 하지 않고 두 부분을 그대로 받아 사용
+        head, attr = self.get_callee(node)
+        if head is None:
+            return
+        if attr is None and head in self.builtin_modules:
+            return
+        # imports 매핑을 사용하여 callee의 모듈 경로 변환
+        mapped = self.imports.get(head)
+        if mapped is not None:
+            # 같은 문자열을 하나의 객체로 공유하여 메모리를 줄이고 dict 조회 시 동일성 비교로 끝나게 함
+            callee = sys.intern(mapped if attr is None else mapped + "." + attr)
+            self.call_info.add_call(self.current_caller, callee)
+
+    def call_children(self, node):
+        # iter_child_nodes로 모든 필드를 훑는 대신 호출 노드의 하위 노드를 직접 수집
+        # func가 `name` 또는 `name.attr` 형태면 get_callee에서 이미 처리했고 하위 호출이 없으므로 건너뜀
+        func = node.func
+        func_type = type(func)
+        if func_type is _NAME or (func_type is _ATTR and type(func.value) is _NAME):
+            children = []
+        else:
+            children = [func]  # `a.b().c()`처럼 func 안에 다른 호출이 있는 경우
+        children.extend(node.args)
+        children.extend(keyword.value for keyword in node.keywords)
+        return children
 
     def get_callee(self, node):
-        if isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name):
-            return f"{node.func.value.id}.{node.func.attr}"
-        elif isinstance(node.func, ast.Name):
-            return node.func.id
-        return None
-
-
-def analyze_file(file_path, call_info):
-    with open(file_path, "r", encoding="utf-8") as file:
-        source_code = file.read()
-    tree = ast.parse(source_code, filename=file_path)
-    visitor = EventAnalysisVisitor(call_info, file_path)
+        func = node.func
+        func_type = type(func)
+        if func_type is _ATTR and type(func.value) is _NAME:
+            return func.value.id, func.attr
+        elif func_type is _NAME:
+            return func.id, None
+        return None, None
+
+    handlers = {
+        ast.Import: handle_Import,
+        ast.ImportFrom: handle_ImportFrom,
+        ast.ClassDef: handle_ClassDef,
+        ast.FunctionDef: handle_FunctionDef,
+        ast.Call: handle_Call,
+    }
+
+
+def hash_file(file_path):
+    with open(file_path, "rb") as file:
+        if sys.version_info >= (3, 11):
+            return hashlib.file_digest(file, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+def parse_source(file_path, digest=None):
+    # digest가 주어지면 소스 해시 + 파이썬 버전 + 도구 버전을 키로 캐시를 조회하고,
+    # 캐시 적중 시에는 소스 파일을 읽지도 파싱하지도 않음
+    if digest is not None:
+        major, minor = sys.version_info[:2]
+        cache_path = os.path.join(CACHE_DIR, f"{digest}-py{major}{minor}-{__version__}.pickle")
+        try:
+            with open(cache_path, "rb") as cache_file:
+                return pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+    with open(file_path, "rb") as file:
+        source = file.read()
+    # bytes를 그대로 넘기면 ast.parse가 BOM과 PEP 263 인코딩 선언을 직접 처리함
+    tree = ast.parse(source, filename=file_path)
+
+    # 해시 계산 이후 파일이 바뀌었다면 다른 내용의 AST가 저장되지 않도록 캐시에 쓰지 않음
+    if digest is not None and hashlib.sha256(source).hexdigest() == digest:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # 중간에 실패해도 깨진 캐시가 남지 않도록 임시 파일에 쓴 뒤 교체
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as cache_file:
+                pickle.dump(tree, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    return tree
+
+
+def analyze_file(file_path, base_path, digest=None):
+    # 워커 프로세스에서 실행되므로 공유 상태 대신 (caller, callee, count) 목록을 반환
+    call_info = CallInfo()
+    tree = parse_source(file_path, digest)
+    visitor = EventAnalysisVisitor(call_info, file_path, base_path)
     visitor.visit(tree)
+    return [(caller, callee, count) for (caller, callee), count in call_info.call_relations.items()]
+
+
+def analyze_files(batch, base_path):
+    # 여러 파일을 한 번에 처리하여 프로세스 간 통신 횟수를 줄임
+    return [(file_path, analyze_file(file_path, base_path, digest)) for file_path, digest in batch]
+
 
+def index_key(base_path):
+    # 도구/파이썬 버전이나 기준 경로가 바뀌면 이전 결과를 재사용할 수 없음
+    return [__version__, "{}.{}".format(*sys.version_info[:2]), base_path]
 
-def walk_and_analyze(directory, ignore_list):
+
+def load_index(base_path):
+    try:
+        with open(INDEX_PATH, "r", encoding="utf-8") as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(index, dict) or index.get("key") != index_key(base_path):
+        return {}
+    return index.get("files", {})
+
+
+def save_index(base_path, files):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{INDEX_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as index_file:
+            json.dump({"key": index_key(base_path), "files": files}, index_file)
+        os.replace(tmp_path, INDEX_PATH)
+    except OSError:
+        pass
+
+
+def iter_py_files(directory, ignore_set, ignore_substrings):
+    # os.walk 대신 os.scandir로 직접 순회하여 DirEntry에 캐시된 타입 정보를 사용하고,
+    # 무시할 디렉터리는 하위로 내려가기 전에 이름만으로 걸러냄
+    try:
+        # 재귀 중에 디렉터리 핸들이 계속 열려 있지 않도록 목록을 먼저 읽고 닫음
+        with os.scandir(directory) as it:
+            entries = list(it)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name in ignore_set or any(ig in entry.path for ig in ignore_substrings):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_py_files(entry.path, ignore_set, ignore_substrings)
+        elif entry.name.endswith(".py") and entry.is_file():
+            yield entry.path
+
+
+def walk_and_analyze(directory, ignore_list, use_cache=True):
+    # 경로 구분자가 없는 항목은 디렉터리/파일 이름과 정확히 비교하고,
+    # 구분자가 포함된 항목만 전체 경로에 대한 부분 문자열 검사로 처리
+    ignore_set = frozenset(ig for ig in ignore_list if os.sep not in ig)
+    ignore_substrings = [ig for ig in ignore_list if os.sep in ig]
+    paths = list(iter_py_files(directory, ignore_set, ignore_substrings))
+
+    index = load_index(directory) if use_cache else {}
+
+    # 해시 계산은 OpenSSL 내부에서 GIL을 놓으므로 프로세스 대신 스레드로 병렬화하고,
+    # 파일 단위 파싱은 서로 독립적이므로 프로세스 풀로 병렬 처리한 뒤 결과를 합침
+    digests = {}
+    file_calls = {}  # 파일 경로 -> [(caller, callee, count)]
+    with concurrent.futures.ThreadPoolExecutor() as io_executor, concurrent.futures.ProcessPoolExecutor() as executor:
+        # 모든 해시를 기다리지 않고 앞쪽 파일의 해시가 나오는 대로 워커에 넘겨 파일 읽기와 파싱을 겹침
+        hashed = io_executor.map(hash_file, paths) if use_cache else itertools.repeat(None)
+        futures = []
+        batch = []
+        for path, digest in zip(paths, hashed, strict=False):
+            digests[path] = digest
+            cached = index.get(path)
+            if cached is not None and cached[0] == digest:
+                # 이전 실행 이후 내용이 바뀌지 않은 파일은 다시 분석하지 않고 저장된 결과를 재사용
+                file_calls[path] = cached[1]
+                continue
+            batch.append((path, digest))
+            if len(batch) == CHUNK_SIZE:
+                futures.append(executor.submit(analyze_files, batch, directory))
+                batch = []
+        if batch:
+            futures.append(executor.submit(analyze_files, batch, directory))
+        for future in futures:
+            file_calls.update(future.result())
+
+    # 실행마다 결과 순서가 같도록 탐색 순서대로 합침
+    # 워커나 인덱스에서 받은 문자열은 파일마다 별개의 객체이므로 다시 intern 하여 공유
     call_info = CallInfo()
-    for root, dirs, files in os.walk(directory, topdown=True):
-        dirs[:] = [d for d in dirs if not any(ig in os.path.join(root, d) for ig in ignore_list)]
-        for file in files:
-            if file.endswith(".py") and not any(ig in os.path.join(root, file) for ig in ignore_list):
-                analyze_file(os.path.join(root, file), call_info)
-    return call_info.call_relations
+    for path in paths:
+        for caller, callee, count in file_calls[path]:
+            call_info.add_call(sys.intern(caller), sys.intern(callee), count)
+
+    if use_cache:
+        save_index(directory, {path: [digests[path], file_calls[path]] for path in paths})
+    return call_info.to_dict()
+
+
+def write_json(path, data):
+    # orjson이 설치되어 있으면 사용하고, 없으면 표준 json으로 같은 형식(들여쓰기 2칸, UTF-8)을 출력
+    if orjson is not None:
+        with open(path, "wb") as json_file:
+            json_file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w", encoding="utf-8") as json_file:
+            json.dump(data, json_file, indent=2, ensure_ascii=False)
+
+
+def write_html(path, html, use_cache=True):
+    data = html.encode("utf-8")
+    if use_cache:
+        # 내용이 이전 실행과 같고 그 사이 파일이 바뀌지 않았다면 다시 쓰지 않음
+        digest = hashlib.sha256(data).hexdigest()
+        try:
+            stat = os.stat(path)
+            with open(TEMPLATE_HASH_PATH, "r", encoding="utf-8") as hash_file:
+                if hash_file.read() == f"{digest} {stat.st_size} {stat.st_mtime_ns}":
+                    return
+        except OSError:
+            pass
+
+    with open(path, "wb") as html_file:
+        html_file.write(data)
+
+    if use_cache:
+        try:
+            stat = os.stat(path)
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(TEMPLATE_HASH_PATH, "w", encoding="utf-8") as hash_file:
+                hash_file.write(f"{digest} {stat.st_size} {stat.st_mtime_ns}")
+        except OSError:
+            pass
 
 
 def load_config():
@@ -139,17 +391,7 @@ def load_config():
         return default_settings
 
 
-settings = load_config()
-call_relations = walk_and_analyze(settings["path"], settings["ignore_list"])
-
-with open("analysis_result.json", "w") as json_file:
-    # defaultdict를 일반 dict로 변환
-    json_data = {caller: dict(callees) for caller, callees in call_relations.items()}
-    json.dump(json_data, json_file, indent=4)
-
-
-# make template.html
-html = f"""
+HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -298,5 +540,23 @@ html = f"""
 </html>
 """
 
-with open("template.html", "w") as html_file:
-    html_file.write(html)
+
+def main():
+    parser = argparse.ArgumentParser(description="Trace call relations between Python modules.")
+    parser.add_argument("--no-cache", action="store_true", help=f"do not read or write the {CACHE_DIR} directory")
+    args = parser.parse_args()
+
+    use_cache = not args.no_cache
+    settings = load_config()
+    call_relations = walk_and_analyze(settings["path"], settings["ignore_list"], use_cache=use_cache)
+
+    # defaultdict는 dict의 하위 클래스이므로 일반 dict로 복사하지 않고 그대로 직렬화
+    write_json("analysis_result.json", call_relations)
+
+    # make template.html
+    html = HTML_TEMPLATE.format(json_data=json.dumps(call_relations))
+    write_html("template.html", html, use_cache=use_cache)
+
+
+if __name__ == "__main__":
+    main()